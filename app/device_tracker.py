@@ -1,5 +1,6 @@
 import os
 import time
+import queue
 import argparse
 import logging
 import paho.mqtt.client as mqtt
@@ -102,22 +103,31 @@ def get_existing_clients():
     '''Retrieve persisted MQTT topics for existing client MACs'''
     retained_queue = Queue(maxsize=Retained_maxcount)
     Log.info('Retrieving retained clients')
+    existing_macs = {}
     try:
         p = Process(target=get_retained_messages, args=(retained_queue,))
         p.start()
-        p.join(timeout=Retained_timeout)
+        # Read while waiting; the process cannot exit until its queued topics are read.
+        topics = []
+        deadline = time.monotonic() + Retained_timeout
+        while len(topics) < Retained_maxcount and time.monotonic() < deadline:
+            try:
+                topics.append(retained_queue.get(timeout=0.1))
+            except queue.Empty:
+                if not p.is_alive():
+                    break
         p.terminate()
         try:
             # Kill process
             p.close()
         except ValueError as e:
             Log.debug(e)
-        if retained_queue.empty():
+        while len(topics) < Retained_maxcount and not retained_queue.empty():
+            topics.append(retained_queue.get_nowait())
+        if not topics:
             Log.info('No retained clients retrieved.')
             return {}
-        existing_macs = {}
-        while not retained_queue.empty():
-            topic = retained_queue.get_nowait()
+        for topic in topics:
             if not topic:
                 break
             Log.debug(f"Existing {topic}")
@@ -156,12 +166,8 @@ def process_by_ap(unifiTracker, last_clients):
     return last_clients
 
 
-def process(last_clients):
-    '''Inner loop of processing.
-    Perform diff between existing clients and last retrieved clients; publish to MQTT.
-    To indicate present state, publish topic and retain with 'home' payload;
-    for away state, publish topic and retain with 'not_home' payload'.
-    '''
+def new_unifi_tracker():
+    '''UnifiTracker configured from options.'''
     unifiTracker = unifi.UnifiTracker(useHostKeys=UseHostKeysFile)
     if SshTimeout is not None:
         unifiTracker.SshTimeout = SshTimeout
@@ -169,6 +175,17 @@ def process(last_clients):
         unifiTracker.MaxIdleTime = MaxIdleTime
     if Processes is not None:
         unifiTracker.Processes = Processes
+    return unifiTracker
+
+
+def process(last_clients, unifiTracker=None):
+    '''Inner loop of processing.
+    Perform diff between existing clients and last retrieved clients; publish to MQTT.
+    To indicate present state, publish topic and retain with 'home' payload;
+    for away state, publish topic and retain with 'not_home' payload'.
+    '''
+    if unifiTracker is None:
+        unifiTracker = new_unifi_tracker()
     for i in range(Snapshot_loop_count):
         try:
             if GroupByAP:
@@ -0,0 +1,362 @@
+import os
+import json
+import math
+import time
+import random
+import resource
+import argparse
+import logging
+import threading
+import multiprocessing
+
+# device_tracker reads credentials at import; the broker stand-in ignores them.
+os.environ.setdefault('MQTT_USERNAME', 'load_test')
+os.environ.setdefault('MQTT_PASSWORD', 'load_test')
+os.environ.setdefault('UNIFI_SSH_USERNAME', 'load_test')
+
+import device_tracker
+import unifi_tracker as unifi
+
+Logger_name = "device_tracker_load_test"
+
+AP_count = 4
+Clients_per_AP = 10
+Event_rate = 2.0
+Duration_secs = 60
+Scan_delay_secs = 5
+AP_delay_secs = 0.2
+Drain_scans = 2
+Seed = None
+# Retained messages read at bootstrap; None for the initial fleet size.
+Retained_maxcount = None
+# Secs to read retained messages at bootstrap.
+Retained_timeout = device_tracker.Retained_timeout
+
+Log = logging.getLogger(Logger_name)
+
+
+class SimulatedFleet():
+    '''Unifi APs answering mca-dump from scripted client state.'''
+    def __init__(self, ap_count: int, ap_delay: float):
+        self.ap_hosts = [f'loadAP{i}' for i in range(ap_count)]
+        # AP hostname to MAC to client.
+        self.ap_clients = {ap_host: {} for ap_host in self.ap_hosts}
+        # Simulated mca-dump response time in seconds.
+        self.ap_delay = ap_delay
+        self._lock = threading.Lock()
+        self._next_mac = 0
+
+    def __getstate__(self):
+        # Pickled into scan processes; lock is not picklable.
+        with self._lock:
+            state = self.__dict__.copy()
+            state['ap_clients'] = {ap: dict(clients) for ap, clients in self.ap_clients.items()}
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def new_mac(self):
+        self._next_mac += 1
+        n = self._next_mac
+        return ':'.join(f'{b:02X}' for b in (0x02, 0, (n >> 24) & 0xff, (n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff))
+
+    def exec_ssh_cmdline(self, user: str=None, host: str=None, cmdline: str=None):
+        '''Stand-in for UnifiTracker.exec_ssh_cmdline.'''
+        time.sleep(self.ap_delay)
+        with self._lock:
+            sta_table = list(self.ap_clients[host].values())
+        return (json.dumps({"hostname": host,
+                            "vap_table": [{"sta_table": sta_table}]}).encode(), b'')
+
+    def join(self, ap_host: str):
+        with self._lock:
+            mac = self.new_mac()
+            self.ap_clients[ap_host][mac] = {'mac': mac, 'hostname': f'load-{mac[-5:].replace(":", "")}',
+                                             'ip': None, 'idletime': 0, 'rssi': -50}
+        return mac
+
+    def leave(self, rand: random.Random):
+        '''Remove a random client; return (mac, AP hostname) or None.'''
+        with self._lock:
+            present = [(mac, ap) for ap, clients in self.ap_clients.items() for mac in clients]
+            if not present:
+                return None
+            mac, ap_host = rand.choice(present)
+            del self.ap_clients[ap_host][mac]
+        return mac, ap_host
+
+    def roam(self, rand: random.Random):
+        '''Move a random client to another AP; return (mac, from AP, to AP) or None.'''
+        with self._lock:
+            present = [(mac, ap) for ap, clients in self.ap_clients.items() for mac in clients]
+            if not present or len(self.ap_hosts) < 2:
+                return None
+            mac, from_ap = rand.choice(present)
+            to_ap = rand.choice([ap for ap in self.ap_hosts if ap != from_ap])
+            self.ap_clients[to_ap][mac] = self.ap_clients[from_ap].pop(mac)
+        return mac, from_ap, to_ap
+
+
+class BrokerStandIn():
+    '''Local MQTT broker stand-in for device_tracker publish and retained subscribe.
+    Matches each publish to the scripted event expecting it to measure latency.
+    '''
+    def __init__(self):
+        self.retained = {}
+        self.published = 0
+        self.unmatched = 0
+        self.coalesced = 0
+        self.bootstrap_republished = 0
+        self.latencies = []
+        # Retained client topics the bootstrap did not read; republished as home by the first scan.
+        self.bootstrap_missing = set()
+        # Topic to (payload, event time) awaiting publish.
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def expect(self, topic: str, payload, event_time: float):
+        '''Register payload expected on topic due to an event.
+        An expectation cancelling an unpublished opposite one means the tracker never sees either.
+        '''
+        with self._lock:
+            pending = self._pending.get(topic)
+            if pending is not None and pending[0] != payload:
+                del self._pending[topic]
+                self.coalesced += 2
+            elif pending is None:
+                self._pending[topic] = (payload, event_time)
+
+    def publish(self, topic: str, payload=None, qos: int=0, retain: bool=False):
+        '''Stand-in for paho.mqtt.client.Client.publish.'''
+        now = time.monotonic()
+        with self._lock:
+            self.published += 1
+            if retain:
+                if payload is None:
+                    self.retained.pop(topic, None)
+                else:
+                    self.retained[topic] = payload
+            pending = self._pending.get(topic)
+            if pending is not None and pending[0] == payload:
+                del self._pending[topic]
+                self.latencies.append(now - pending[1])
+            elif topic in self.bootstrap_missing and payload == device_tracker.Home_payload:
+                self.bootstrap_missing.discard(topic)
+                self.bootstrap_republished += 1
+            else:
+                self.unmatched += 1
+        return (topic, payload)
+
+    def callback(self, callback, topics: str, userdata=None, **kwargs):
+        '''Stand-in for paho.mqtt.subscribe.callback delivering retained messages.'''
+        levels = topics.split('/')
+        with self._lock:
+            retained = list(self.retained)
+        for topic in retained:
+            parts = topic.split('/')
+            if len(parts) == len(levels) and all(l in ('+', p) for l, p in zip(levels, parts)):
+                callback(None, userdata, _Message(topic))
+
+    @property
+    def unpublished(self):
+        with self._lock:
+            return len(self._pending)
+
+
+class _Message():
+    def __init__(self, topic: str):
+        self.topic = topic
+
+
+def client_topic(mac: str, ap_hostname: str):
+    '''device_tracker topic for a client.'''
+    if device_tracker.GroupByAP:
+        return f'{device_tracker.Topic_base}/{ap_hostname}/{mac}'
+    return f'{device_tracker.Topic_base}/{mac}'
+
+
+def populate(fleet: SimulatedFleet, broker: BrokerStandIn, clients_per_ap: int):
+    '''Initial clients, already retained as home from a previous run.'''
+    for ap_host in fleet.ap_hosts:
+        for _ in range(clients_per_ap):
+            mac = fleet.join(ap_host)
+            broker.retained[client_topic(mac, ap_host)] = device_tracker.Home_payload
+
+
+def run_events(fleet: SimulatedFleet, broker: BrokerStandIn, rand: random.Random,
+               rate: float, duration: float, counts: dict):
+    '''Apply random join/leave/roam events at rate per second for duration seconds.'''
+    end = time.monotonic() + duration
+    while True:
+        time.sleep(rand.expovariate(rate))
+        if time.monotonic() >= end:
+            break
+        kind = rand.choice(('join', 'leave', 'roam'))
+        now = time.monotonic()
+        if kind == 'join':
+            ap_host = rand.choice(fleet.ap_hosts)
+            mac = fleet.join(ap_host)
+            broker.expect(client_topic(mac, ap_host), device_tracker.Home_payload, now)
+        elif kind == 'leave':
+            left = fleet.leave(rand)
+            if left is None:
+                continue
+            broker.expect(client_topic(*left), device_tracker.Away_payload, now)
+        else:
+            roamed = fleet.roam(rand)
+            if roamed is None:
+                continue
+            mac, from_ap, to_ap = roamed
+            if device_tracker.GroupByAP:
+                broker.expect(client_topic(mac, from_ap), device_tracker.Away_payload, now)
+                broker.expect(client_topic(mac, to_ap), device_tracker.Home_payload, now)
+        counts[kind] += 1
+
+
+def percentile(values: list[float], pct: float):
+    '''Nearest-rank percentile.'''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered), max(1, math.ceil(pct / 100 * len(ordered)))) - 1]
+
+
+def current_rss_kb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        return None
+
+
+def run():
+    '''Bootstrap and run the device_tracker loop against the simulated fleet; return report.'''
+    rand = random.Random(Seed)
+    fleet = SimulatedFleet(AP_count, AP_delay_secs)
+    broker = BrokerStandIn()
+    populate(fleet, broker, Clients_per_AP)
+    Log.info(f'Load test: {AP_count} APs, {Clients_per_AP} clients per AP, {Event_rate} events/sec.')
+
+    device_tracker.AP_hosts = fleet.ap_hosts
+    device_tracker.Scan_delay_secs = Scan_delay_secs
+    device_tracker.Snapshot_loop_count = int(Duration_secs / Scan_delay_secs) + 1 + Drain_scans
+    device_tracker.Mqtt_client = broker
+    device_tracker.subscribe = broker
+    device_tracker.Retained_maxcount = len(broker.retained) if Retained_maxcount is None else Retained_maxcount
+    device_tracker.Retained_timeout = Retained_timeout
+
+    start = time.monotonic()
+    existing_clients = device_tracker.get_existing_clients()
+    bootstrap_secs = time.monotonic() - start
+    broker.bootstrap_missing = set(broker.retained) - {client_topic(mac, client.get('ap_hostname'))
+                                                       for mac, client in existing_clients.items()}
+    bootstrap_missing = len(broker.bootstrap_missing)
+    if bootstrap_missing > 0 and Retained_maxcount is None:
+        Log.warning(f'Bootstrap missed {bootstrap_missing} of {len(broker.retained)} retained clients; '
+                    f'first scan republishes them. Consider a longer --retainedTimeout.')
+
+    unifiTracker = device_tracker.new_unifi_tracker()
+    unifiTracker.exec_ssh_cmdline = fleet.exec_ssh_cmdline
+    tracker_cpu = {}
+    def process():
+        cpu_start = time.thread_time()
+        device_tracker.process(existing_clients, unifiTracker)
+        tracker_cpu['secs'] = time.thread_time() - cpu_start
+
+    counts = {'join': 0, 'leave': 0, 'roam': 0}
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # Harness state (fleet, broker) is already allocated; growth from here is mostly the tracker.
+    rss_before_tracker = current_rss_kb()
+    tracker_thread = threading.Thread(target=process, name='device_tracker')
+    tracker_thread.start()
+    run_events(fleet, broker, rand, Event_rate, Duration_secs, counts)
+    tracker_thread.join()
+    elapsed = time.monotonic() - start
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    rss_after_tracker = current_rss_kb()
+    latencies = broker.latencies
+    return {
+        'aps': AP_count,
+        'clients': sum(len(c) for c in fleet.ap_clients.values()),
+        'existing_clients': len(existing_clients),
+        'bootstrap_missing': bootstrap_missing,
+        'bootstrap_secs': round(bootstrap_secs, 3),
+        'elapsed_secs': round(elapsed, 3),
+        'events': counts,
+        'messages': {'published': broker.published,
+                     'matched': len(latencies),
+                     'bootstrap_republished': broker.bootstrap_republished,
+                     'unmatched': broker.unmatched,
+                     'coalesced_events': broker.coalesced,
+                     'unpublished_events': broker.unpublished},
+        'latency_secs': {f'p{p}': None if percentile(latencies, p) is None else round(percentile(latencies, p), 3)
+                         for p in (50, 90, 95, 99, 100)},
+        'tracker_cpu_secs': round(tracker_cpu.get('secs', 0), 3),
+        'scan_processes_cpu_secs': round(max(0.0, children.ru_utime + children.ru_stime
+                                             - children_start.ru_utime - children_start.ru_stime), 3),
+        'rss_kb': {
+            # Whole load test process: tracker plus simulated fleet and broker stand-in.
+            'process_before_tracker': rss_before_tracker,
+            'process_after_tracker': rss_after_tracker,
+            'tracker_growth': None if rss_before_tracker is None or rss_after_tracker is None
+                              else rss_after_tracker - rss_before_tracker,
+            # ru_maxrss is in KB on Linux.
+            'process_max': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            # Largest child: scan pool workers and the retained messages process,
+            # forked from this process so including pages shared with it.
+            'child_processes_max': children.ru_maxrss,
+        },
+    }
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description="End-to-end event to MQTT publish latency of device_tracker "
+                                             "against a simulated AP fleet and local MQTT broker stand-in.")
+    ap_log = ap.add_mutually_exclusive_group()
+    ap_log.add_argument("--debug", required=False, action='store_true', default=False, help="Enable debug level logging.")
+    ap_log.add_argument("--info", required=False, action='store_true', default=False, help="Enable info level logging.")
+    ap.add_argument("--aps", type=int, required=False, action='store', default=AP_count, help="Number of simulated APs.")
+    ap.add_argument("--clients", type=int, required=False, action='store', default=Clients_per_AP, help="Initial clients per AP.")
+    ap.add_argument("--eventRate", type=float, required=False, action='store', default=Event_rate, help="Join/leave/roam events per sec.")
+    ap.add_argument("--duration", type=float, required=False, action='store', default=Duration_secs, help="Secs to generate events.")
+    ap.add_argument("--delay", type=float, required=False, action='store', default=Scan_delay_secs, help="Loop delay seconds.")
+    ap.add_argument("--apDelay", type=float, required=False, action='store', default=AP_delay_secs, help="Simulated mca-dump secs per AP.")
+    ap.add_argument("--processes", type=int, required=False, action='store', default=device_tracker.Processes, help="Scans run in parallel; set to 0 for sequential.")
+    ap.add_argument("--maxIdleTime", type=int, required=False, action='store', default=device_tracker.MaxIdleTime, help="Maximum AP client idle time in secs.")
+    ap.add_argument("--groupByAP", required=False, action='store_true', default=device_tracker.GroupByAP, help="Group clients by AP hostname.")
+    ap.add_argument("--retainedMaxcount", type=int, required=False, action='store', default=Retained_maxcount,
+                    help="Retained messages read at bootstrap; defaults to the initial fleet size.")
+    ap.add_argument("--retainedTimeout", type=float, required=False, action='store', default=Retained_timeout,
+                    help="Secs to read retained messages at bootstrap.")
+    ap.add_argument("--seed", type=int, required=False, action='store', default=Seed, help="Random seed for the event script.")
+
+    args = ap.parse_args()
+    if args.aps < 1 or args.aps > unifi.UnifiTracker().MAX_AP_HOST_SCANS:
+        ap.error(f"--aps must be between 1 and {unifi.UnifiTracker().MAX_AP_HOST_SCANS}.")
+    if args.eventRate <= 0 or args.delay <= 0 or args.retainedTimeout <= 0:
+        ap.error("--eventRate, --delay and --retainedTimeout must be positive.")
+    if args.retainedMaxcount is not None and args.retainedMaxcount < 1:
+        # Queue maxsize 0 is unbounded.
+        ap.error("--retainedMaxcount must be at least 1.")
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO if args.info else logging.WARNING,
+                        format='%(asctime)s %(levelname)s:%(name)s:%(message)s',
+                        datefmt='%m-%d-%Y %H:%M:%S')
+    # Bootstrap subscribe stand-in must be inherited by the retained messages process.
+    multiprocessing.set_start_method('fork')
+    AP_count = args.aps
+    Clients_per_AP = args.clients
+    Event_rate = args.eventRate
+    Duration_secs = args.duration
+    Scan_delay_secs = args.delay
+    AP_delay_secs = args.apDelay
+    Seed = args.seed
+    Retained_maxcount = args.retainedMaxcount
+    Retained_timeout = args.retainedTimeout
+    device_tracker.Processes = args.processes
+    device_tracker.MaxIdleTime = args.maxIdleTime
+    device_tracker.GroupByAP = args.groupByAP
+
+    print(json.dumps(run(), indent=2))
@@ -1,9 +1,12 @@
 import os
+import copy
 import json
 import logging
 from paramiko import WarningPolicy
 from paramiko import SSHClient
 import socket
+import time
+import threading
 from multiprocessing import Pool
 
 _LOGGER = logging.getLogger("unifi_tracker")
@@ -142,12 +145,15 @@ class UnifiTracker():
             all_ap_mac_clients.append(macs_res)
         return all_ap_mac_clients
 
-    def get_ap_mac_clients_filtered(self, ssh_username, ap_hosts, last_mac_clients):
-        mac_clients = {}
+    def scan_ap_hosts(self, ssh_username: str, ap_hosts: list[str]):
+        '''List of unfiltered MAC to client dicts, one per AP host.'''
         if self._processes == 0:
-            all_ap_mac_clients = self.sequential_scan(ssh_username, ap_hosts)
-        else:
-            all_ap_mac_clients = self.parallel_scan(ssh_username, ap_hosts)
+            return self.sequential_scan(ssh_username, ap_hosts)
+        return self.parallel_scan(ssh_username, ap_hosts)
+
+    def filter_ap_mac_clients(self, all_ap_mac_clients: list[dict], last_mac_clients: dict):
+        '''Merge per AP scan results; exclude clients above idle time threshold.'''
+        mac_clients = {}
         for ap_mac_clients in all_ap_mac_clients:
             if self._maxIdleTime is None:
                 mac_clients.update(ap_mac_clients)
@@ -163,17 +169,19 @@ class UnifiTracker():
                     mac_clients[mac] = client
         return mac_clients
 
-    def scan_aps(self, ssh_username: str, ap_hosts: list[str], last_mac_clients: dict={}):
-        '''Retrieve and merge clients from all APs; diff with last retrieved.
-        Return tuple: dict of clients, list of client adds, list of client deletes.
-        All AP retrievals need to succeed in order to process diff.
-        '''
-        _LOGGER.debug("scan_aps start")
+    def get_ap_mac_clients_filtered(self, ssh_username, ap_hosts, last_mac_clients):
+        all_ap_mac_clients = self.scan_ap_hosts(ssh_username, ap_hosts)
+        return self.filter_ap_mac_clients(all_ap_mac_clients, last_mac_clients)
+
+    def check_ap_hosts(self, ap_hosts: list[str]):
+        '''Raise if too many AP hosts to scan.'''
         if len(ap_hosts) > self.MAX_AP_HOST_SCANS:
             raise UnifiTrackerException(f"Exceeded limit of {self.MAX_AP_HOST_SCANS} APs that can be scanned in parallel.")
+
+    def diff_clients(self, mac_clients: dict, last_mac_clients: dict):
+        '''Return tuple: list of client adds, list of client deletes.'''
         added = []
         deleted = []
-        mac_clients = self.get_ap_mac_clients_filtered(ssh_username, ap_hosts, last_mac_clients)
         for mac, client in mac_clients.items():
             if mac not in last_mac_clients:
                 added.append(mac)
@@ -182,21 +190,12 @@ class UnifiTracker():
             if mac not in mac_clients:
                 deleted.append(mac)
                 _LOGGER.info(f"removed {self.get_client_display_name(client)}")
-        _LOGGER.debug("scanning end")
+        return added, deleted
 
-        return mac_clients, added, deleted
-    
-    def scan_by_ap(self, ssh_username: str, ap_hosts: list[str], last_mac_clients: dict={}):
-        '''Retrieve and merge clients from all APs; diff with last grouped by AP hostname.
-        Return tuple: dict of clients, dict of AP client adds, dict of AP client deletes.
-        All AP retrievals need to succeed in order to process diff.
-        '''
-        _LOGGER.debug("scan_by_ap start")
-        if len(ap_hosts) > self.MAX_AP_HOST_SCANS:
-            raise UnifiTrackerException(f"Exceeded limit of {self.MAX_AP_HOST_SCANS} APs that can be scanned in parallel.")
+    def diff_clients_by_ap(self, mac_clients: dict, last_mac_clients: dict):
+        '''Return tuple: dict of AP client adds, dict of AP client deletes.'''
         added_by_ap = {}
         deleted_by_ap = {}
-        mac_clients = self.get_ap_mac_clients_filtered(ssh_username, ap_hosts, last_mac_clients)
         for mac, client in mac_clients.items():
             client_ap = client['ap_hostname']
             if mac not in last_mac_clients:
@@ -221,7 +220,153 @@ class UnifiTracker():
                     deleted_by_ap[client_ap] = []
                 deleted_by_ap[client_ap].append(mac)
                 _LOGGER.info(f"removed {self.get_client_display_name(client)}")
+        return added_by_ap, deleted_by_ap
+
+    def scan_aps(self, ssh_username: str, ap_hosts: list[str], last_mac_clients: dict={}):
+        '''Retrieve and merge clients from all APs; diff with last retrieved.
+        Return tuple: dict of clients, list of client adds, list of client deletes.
+        All AP retrievals need to succeed in order to process diff.
+        '''
+        _LOGGER.debug("scan_aps start")
+        self.check_ap_hosts(ap_hosts)
+        mac_clients = self.get_ap_mac_clients_filtered(ssh_username, ap_hosts, last_mac_clients)
+        added, deleted = self.diff_clients(mac_clients, last_mac_clients)
+        _LOGGER.debug("scanning end")
+
+        return mac_clients, added, deleted
+    
+    def scan_by_ap(self, ssh_username: str, ap_hosts: list[str], last_mac_clients: dict={}):
+        '''Retrieve and merge clients from all APs; diff with last grouped by AP hostname.
+        Return tuple: dict of clients, dict of AP client adds, dict of AP client deletes.
+        All AP retrievals need to succeed in order to process diff.
+        '''
+        _LOGGER.debug("scan_by_ap start")
+        self.check_ap_hosts(ap_hosts)
+        mac_clients = self.get_ap_mac_clients_filtered(ssh_username, ap_hosts, last_mac_clients)
+        added_by_ap, deleted_by_ap = self.diff_clients_by_ap(mac_clients, last_mac_clients)
         _LOGGER.debug("scanning end")
 
         return mac_clients, added_by_ap, deleted_by_ap
 
+
+class _InFlightScan():
+    '''Scan shared by callers requesting the same AP set.'''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.time = None
+
+
+class ScanService():
+    '''Share AP scans between callers embedding the same UnifiTracker.
+    Concurrent requests for the same AP set join one in-flight scan, and results
+    are cached for CacheTtl seconds. Each caller passes its own last_mac_clients,
+    so diffs stay per caller. Coalescing is per process, across threads.
+    A failed scan raises an exception of the same type in every caller sharing it.
+    '''
+    def __init__(self, unifiTracker: UnifiTracker, cacheTtl: float=0):
+        '''Initialize with the UnifiTracker used to scan and optional cacheTtl property.'''
+        self._unifiTracker = unifiTracker
+        # Seconds a completed scan is reused; 0 only coalesces concurrent scans.
+        self._cacheTtl = cacheTtl
+        self._lock = threading.Lock()
+        # Sequential scans share the tracker SSH client; run one at a time.
+        self._ssh_lock = threading.Lock()
+        self._scans = {}
+
+    @property
+    def Tracker(self):
+        '''UnifiTracker used to scan APs.'''
+        return self._unifiTracker
+
+    @property
+    def CacheTtl(self):
+        '''Seconds a completed scan is reused; 0 only coalesces concurrent scans.'''
+        return self._cacheTtl
+
+    @CacheTtl.setter
+    def CacheTtl(self, value: float):
+        self._cacheTtl = value
+
+    def invalidate(self):
+        '''Drop cached scans; in-flight scans still complete for their callers.'''
+        with self._lock:
+            self._scans = {key: scan for key, scan in self._scans.items() if not scan.done.is_set()}
+
+    def _run_scan(self, ssh_username: str, ap_hosts: list[str]):
+        if self._unifiTracker.Processes == 0:
+            with self._ssh_lock:
+                all_ap_mac_clients = self._unifiTracker.scan_ap_hosts(ssh_username, ap_hosts)
+        else:
+            all_ap_mac_clients = self._unifiTracker.scan_ap_hosts(ssh_username, ap_hosts)
+        return dict(zip(ap_hosts, all_ap_mac_clients))
+
+    def _shared_error(self, error: BaseException):
+        '''Copy of error for a joined caller; the leader raised the original.'''
+        try:
+            shared = copy.copy(error)
+        except Exception:
+            return error
+        shared.__cause__ = error.__cause__
+        shared.__context__ = error.__context__
+        shared.__suppress_context__ = error.__suppress_context__
+        return shared
+
+    def get_ap_scans(self, ssh_username: str, ap_hosts: list[str]):
+        '''List of unfiltered MAC to client dicts, one per AP host, from cache or a shared scan.'''
+        key = (ssh_username, frozenset(ap_hosts))
+        with self._lock:
+            # Evict expired scans of any AP set.
+            now = time.monotonic()
+            self._scans = {k: s for k, s in self._scans.items()
+                           if not s.done.is_set() or now - s.time <= self._cacheTtl}
+            scan = self._scans.get(key)
+            leader = scan is None
+            if leader:
+                scan = _InFlightScan()
+                self._scans[key] = scan
+        if leader:
+            _LOGGER.debug(f'Scanning {len(key[1])} APs for shared callers.')
+            try:
+                scan.result = self._run_scan(ssh_username, list(key[1]))
+            except BaseException as e:
+                scan.error = e
+                raise
+            finally:
+                scan.time = time.monotonic()
+                if scan.result is None or self._cacheTtl <= 0:
+                    # Failed scans are not cached.
+                    with self._lock:
+                        if self._scans.get(key) is scan:
+                            del self._scans[key]
+                scan.done.set()
+        else:
+            _LOGGER.debug('Joining shared scan.')
+            scan.done.wait()
+            if scan.result is None:
+                raise self._shared_error(scan.error)
+        # Copy clients so callers cannot alter the shared scan.
+        return [{mac: dict(client) for mac, client in scan.result[ap_host].items()} for ap_host in ap_hosts]
+
+    def scan_aps(self, ssh_username: str, ap_hosts: list[str], last_mac_clients: dict={}):
+        '''Same as UnifiTracker.scan_aps using a shared scan.'''
+        _LOGGER.debug("scan_aps start")
+        self._unifiTracker.check_ap_hosts(ap_hosts)
+        all_ap_mac_clients = self.get_ap_scans(ssh_username, ap_hosts)
+        mac_clients = self._unifiTracker.filter_ap_mac_clients(all_ap_mac_clients, last_mac_clients)
+        added, deleted = self._unifiTracker.diff_clients(mac_clients, last_mac_clients)
+        _LOGGER.debug("scanning end")
+
+        return mac_clients, added, deleted
+
+    def scan_by_ap(self, ssh_username: str, ap_hosts: list[str], last_mac_clients: dict={}):
+        '''Same as UnifiTracker.scan_by_ap using a shared scan.'''
+        _LOGGER.debug("scan_by_ap start")
+        self._unifiTracker.check_ap_hosts(ap_hosts)
+        all_ap_mac_clients = self.get_ap_scans(ssh_username, ap_hosts)
+        mac_clients = self._unifiTracker.filter_ap_mac_clients(all_ap_mac_clients, last_mac_clients)
+        added_by_ap, deleted_by_ap = self._unifiTracker.diff_clients_by_ap(mac_clients, last_mac_clients)
+        _LOGGER.debug("scanning end")
+
+        return mac_clients, added_by_ap, deleted_by_ap
@@ -5,3 +5,4 @@ cp ../src/unifi_tracker/unifi_tracker.py .
 python3 test_diff.py
 python3 test_diff_by_ap.py
 python3 test_property_setters.py
+python3 test_scan_service.py
@@ -0,0 +1,186 @@
+import unittest
+import json
+import time
+import threading
+import unifi_tracker as unifi
+import mock_clients as mcl
+
+
+class MockScan():
+    '''Count calls to exec_ssh_cmdline; optionally block until released.'''
+    def __init__(self, ap_clients, wait: bool=False):
+        self.ap_clients = ap_clients
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not wait:
+            self.release.set()
+
+    def exec_ssh_cmdline(self, user: str=None, host: str=None, cmdline: str=None):
+        self.calls += 1
+        self.started.set()
+        self.release.wait()
+        return (json.dumps({"hostname": host,
+                            "vap_table": [{"sta_table": self.ap_clients[host]}]}).encode(), b'')
+
+
+class CountingEvent(threading.Event):
+    '''Event counting callers blocked in wait.'''
+    def __init__(self):
+        super().__init__()
+        self.waiting = 0
+        self._count_lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        with self._count_lock:
+            self.waiting += 1
+        return super().wait(timeout)
+
+
+def wait_for(condition, timeout: float=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def new_scan_service(mock, cacheTtl: float=0):
+    unifiTracker = unifi.UnifiTracker()
+    unifiTracker.Processes = 0
+    unifiTracker.exec_ssh_cmdline = mock.exec_ssh_cmdline
+    return unifi.ScanService(unifiTracker, cacheTtl=cacheTtl)
+
+
+class TestScanService(unittest.TestCase):
+
+    def test_cacheTtl_default(self):
+        # CacheTtl defaults to 0
+        scanService = unifi.ScanService(unifi.UnifiTracker())
+        assert(0 == scanService.CacheTtl)
+
+    def test_same_diff(self):
+        '''Expected same result as UnifiTracker.scan_aps.'''
+        mock = MockScan({mcl.TEST_AP: mcl.TEST_CLIENTS1})
+        scanService = new_scan_service(mock)
+        last = {c['mac'].upper(): c for c in mcl.TEST_CLIENTS0}
+        diff = scanService.scan_aps('user', [mcl.TEST_AP], last)
+        expect = scanService.Tracker.scan_aps('user', [mcl.TEST_AP], last)
+        assert(expect == diff)
+
+    def test_cached_per_caller_diff(self):
+        '''One scan within TTL; each caller diffs with its own last clients.'''
+        mock = MockScan({mcl.TEST_AP: mcl.TEST_CLIENTS1})
+        scanService = new_scan_service(mock, cacheTtl=60)
+        last0 = {c['mac'].upper(): c for c in mcl.TEST_CLIENTS0}
+        last1 = {c['mac'].upper(): c for c in mcl.TEST_CLIENTS1}
+        _, added0, deleted0 = scanService.scan_aps('user', [mcl.TEST_AP], last0)
+        _, added1, deleted1 = scanService.scan_aps('user', [mcl.TEST_AP], last1)
+        assert(1 == mock.calls)
+        assert(([mcl.TEST_CLIENTS1[1]['mac'].upper()], [mcl.TEST_CLIENTS0[1]['mac'].upper()]) == (added0, deleted0))
+        assert(([], []) == (added1, deleted1))
+
+    def test_ttl_expired(self):
+        '''Rescan once TTL expired or cache invalidated.'''
+        mock = MockScan({mcl.TEST_AP: mcl.TEST_CLIENTS1})
+        scanService = new_scan_service(mock, cacheTtl=0)
+        scanService.scan_aps('user', [mcl.TEST_AP])
+        time.sleep(0.01)
+        scanService.scan_aps('user', [mcl.TEST_AP])
+        assert(2 == mock.calls)
+        scanService.CacheTtl = 60
+        scanService.invalidate()
+        scanService.scan_aps('user', [mcl.TEST_AP])
+        assert(3 == mock.calls)
+
+    def test_concurrent_single_flight(self):
+        '''Concurrent callers for the same AP set join one in-flight scan.'''
+        mock = MockScan({mcl.TEST_AP: mcl.TEST_CLIENTS0, mcl.TEST_AP2: mcl.TEST_CLIENT4}, wait=True)
+        # No cache; callers can only share the in-flight scan.
+        scanService = new_scan_service(mock, cacheTtl=0)
+        results = []
+        def scan(ap_hosts):
+            results.append(scanService.scan_by_ap('user', ap_hosts))
+        threads = [threading.Thread(target=scan, args=([mcl.TEST_AP, mcl.TEST_AP2],))]
+        threads[0].start()
+        mock.started.wait()
+        done = CountingEvent()
+        scanService._scans[('user', frozenset([mcl.TEST_AP, mcl.TEST_AP2]))].done = done
+        # Same AP set in a different order.
+        threads += [threading.Thread(target=scan, args=([mcl.TEST_AP2, mcl.TEST_AP],)) for _ in range(3)]
+        for t in threads[1:]:
+            t.start()
+        assert(wait_for(lambda: 3 == done.waiting))
+        mock.release.set()
+        for t in threads:
+            t.join()
+        assert(2 == mock.calls)
+        assert(4 == len(results))
+        assert(all(r[0] == results[0][0] for r in results))
+
+    def test_shared_error(self):
+        '''Failed scan not cached.'''
+        mock = MockScan({mcl.TEST_AP: mcl.TEST_CLIENTS0})
+        scanService = new_scan_service(mock, cacheTtl=60)
+        with self.assertRaises(KeyError):
+            scanService.scan_aps('user', [mcl.TEST_AP2])
+        mock.ap_clients[mcl.TEST_AP2] = mcl.TEST_CLIENT4
+        scan = scanService.scan_aps('user', [mcl.TEST_AP2])
+        assert([mcl.TEST_CLIENT4[0]['mac'].upper()] == scan[1])
+
+    def test_joined_error(self):
+        '''Joined callers get their own exception of the failed scan type.'''
+        mock = MockScan({mcl.TEST_AP: mcl.TEST_CLIENTS0}, wait=True)
+        scanService = new_scan_service(mock)
+        errors = []
+        def scan():
+            try:
+                scanService.scan_aps('user', [mcl.TEST_AP2])
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=scan)]
+        threads[0].start()
+        mock.started.wait()
+        done = CountingEvent()
+        scanService._scans[('user', frozenset([mcl.TEST_AP2]))].done = done
+        threads += [threading.Thread(target=scan) for _ in range(2)]
+        for t in threads[1:]:
+            t.start()
+        assert(wait_for(lambda: 2 == done.waiting))
+        mock.release.set()
+        for t in threads:
+            t.join()
+        assert(3 == len(errors))
+        assert(all(type(e) is KeyError and e.args == errors[0].args for e in errors))
+        assert(3 == len({id(e) for e in errors}))
+
+    def test_expired_evicted(self):
+        '''Expired scans of other AP sets are evicted.'''
+        mock = MockScan({mcl.TEST_AP: mcl.TEST_CLIENTS0, mcl.TEST_AP2: mcl.TEST_CLIENT4})
+        scanService = new_scan_service(mock, cacheTtl=0)
+        scanService.scan_aps('user', [mcl.TEST_AP])
+        assert({} == scanService._scans)
+        scanService.CacheTtl = 0.01
+        scanService.scan_aps('user', [mcl.TEST_AP])
+        assert(1 == len(scanService._scans))
+        time.sleep(0.02)
+        scanService.scan_aps('user', [mcl.TEST_AP2])
+        assert([('user', frozenset([mcl.TEST_AP2]))] == list(scanService._scans))
+
+    def test_interrupted_scan(self):
+        '''Scan interrupted by BaseException releases joined and later callers.'''
+        mock = MockScan({mcl.TEST_AP: mcl.TEST_CLIENTS0})
+        scanService = new_scan_service(mock, cacheTtl=60)
+        def interrupted_exec_ssh_cmdline(user: str=None, host: str=None, cmdline: str=None):
+            raise KeyboardInterrupt()
+        scanService.Tracker.exec_ssh_cmdline = interrupted_exec_ssh_cmdline
+        with self.assertRaises(KeyboardInterrupt):
+            scanService.scan_aps('user', [mcl.TEST_AP])
+        assert({} == scanService._scans)
+        scanService.Tracker.exec_ssh_cmdline = mock.exec_ssh_cmdline
+        scan = scanService.scan_aps('user', [mcl.TEST_AP])
+        assert(len(mcl.TEST_CLIENTS0) == len(scan[0]))
+
+if __name__ == "__main__":
+    unittest.main()